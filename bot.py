@@ -1,22 +1,32 @@
 import os
 import logging
+import logging.handlers
+import queue
+import atexit
 import asyncio
+import math
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import urlparse
 from datetime import datetime
 from telegram import Update, PhotoSize
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
+    PicklePersistence,
     filters,
     ContextTypes,
 )
 from telegram.error import TelegramError, NetworkError, TimedOut
-from openai import OpenAI, APIError, RateLimitError, APIConnectionError
+from telegram.helpers import escape_markdown
+from openai import AsyncOpenAI, APIError, RateLimitError, APIConnectionError
 from dotenv import load_dotenv
-import base64
 from io import BytesIO
 from PIL import Image
-import requests
+import httpx
 
 # Load environment variables
 load_dotenv()
@@ -25,70 +35,90 @@ load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Webhook mode (optional), the bot falls back to long polling when unset
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# Shared HTTP client for OpenAI calls and image downloads, keeps connections
+# alive so repeated requests skip the TCP/TLS handshake
+http_client = httpx.AsyncClient(
+    timeout=30.0,
+    limits=httpx.Limits(
+        max_connections=100, max_keepalive_connections=30, keepalive_expiry=60.0
+    ),
+)
+
+# The SDK retries connection errors, 429s and 5xx responses with exponential
+# backoff and jitter, honouring Retry-After
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY, http_client=http_client, max_retries=3, timeout=60.0
+)
+
+# Image downloads
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # bytes read per chunk when downloading images
+MAX_DOWNLOAD_SIZE = 10 * 1024 * 1024  # Telegram's upload limit for photos
 
 # Create directories
 os.makedirs("logs", exist_ok=True)
 os.makedirs("generated_images", exist_ok=True)
 os.makedirs("uploaded_images", exist_ok=True)
 
-# Configure logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler(f'logs/bot_{datetime.now().strftime("%Y%m%d")}.log'),
-        logging.StreamHandler(),
-    ],
+# User directories already created by this process
+ensured_dirs: set[str] = set()
+
+# Configure logging: handlers only enqueue records, a background thread writes them
+log_formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
+# Rotate at midnight so each day's log stays in its own file
+file_handler = logging.handlers.TimedRotatingFileHandler(
+    "logs/bot.log", when="midnight", backupCount=14, encoding="utf-8"
+)
+file_handler.setFormatter(log_formatter)
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(log_formatter)
+
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
 logger = logging.getLogger(__name__)
 
-# Rate limiting dictionary
-user_last_request = {}
-REQUEST_COOLDOWN = 10  # seconds between requests
-
-
-def save_generated_image(image_url, user_id, image_type="generated"):
-    """Download and save generated image from URL"""
-    try:
-        # Create user directory
-        user_dir = f"generated_images/{user_id}"
-        os.makedirs(user_dir, exist_ok=True)
-
-        # Generate filename with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{image_type}_{timestamp}.png"
-        filepath = os.path.join(user_dir, filename)
-
-        # Download image from URL
-        response = requests.get(image_url, timeout=30)
-        response.raise_for_status()
-
-        # Save image
-        with open(filepath, "wb") as f:
-            f.write(response.content)
-
-        # Get file size
-        file_size = os.path.getsize(filepath)
-        file_size_kb = file_size / 1024
+# Rate limiting token buckets: user_id -> (tokens, last_refill_monotonic_time)
+# kept in least recently used order, so the oldest bucket is always first
+rate_limit_buckets: OrderedDict[int, tuple[float, float]] = OrderedDict()
+REQUEST_COOLDOWN = 10  # seconds to earn back one request
+RATE_LIMIT_CAPACITY = 3  # requests a user can burst before the cooldown applies
+RATE_LIMIT_REFILL_RATE = 1 / REQUEST_COOLDOWN  # tokens earned per second
+RATE_LIMIT_SWEEP_INTERVAL = 60  # seconds between sweeps of idle buckets
+RATE_LIMIT_MAX_USERS = 10_000  # hard cap on tracked users between sweeps
+# Sweeper task handle, kept out of bot_data because that gets pickled
+rate_limit_sweeper: Optional[asyncio.Task] = None
 
-        logger.info(
-            f"Saved {image_type} image for user {user_id}: {filename} ({file_size_kb:.2f} KB)"
-        )
+# Prompt cache: sha256(normalized prompt) -> Telegram file_id of the sent photo
+prompt_cache: OrderedDict[bytes, str] = OrderedDict()
+PROMPT_CACHE_SIZE = 10_000  # most recently used prompts to keep
 
-        return filepath, file_size_kb
+# Concurrency: cap DALL-E calls across all users and allow one request per user
+MAX_CONCURRENT_GENERATIONS = 10
+generation_semaphore = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+users_in_flight: set[int] = set()
 
-    except Exception as e:
-        logger.error(f"Error saving generated image for user {user_id}: {str(e)}")
-        return None, 0
+# Stats: only the start of the last prompt is kept per user
+LAST_PROMPT_LENGTH = 50
 
+# Batch generation: one rate limit token is spent per prompt
+BATCH_MAX_PROMPTS = RATE_LIMIT_CAPACITY
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    logger.info(f"User {user.id} ({user.first_name}) started the bot")
 
-    welcome_message = f"""
-Welcome to AI Image Generator Bot, {user.first_name}!
+# Static command replies, built once at import time
+WELCOME_TEMPLATE = """
+Welcome to AI Image Generator Bot, {first_name}!
 
 Transform your ideas into stunning visuals using OpenAI's DALL-E 3.
 
@@ -125,20 +155,14 @@ Example: Send a photo, then say:
 /stats - View your statistics
 /gallery - View saved images info
 /clear - Clear uploaded image
+/batch - Generate several images at once
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
 Ready? Send a text prompt or upload an image!
-    """
-
-    await update.message.reply_text(welcome_message, parse_mode="Markdown")
-
+"""
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    logger.info(f"User {user.id} requested help")
-
-    help_text = """
+HELP_TEXT = """
 **Complete Guide**
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
@@ -186,6 +210,18 @@ Send any image, then describe how to transform it:
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
+**Batch Generation**
+
+Use /batch with one prompt per line to create several images at once:
+
+/batch A lighthouse at dawn
+A lighthouse at noon
+A lighthouse at night
+
+Each prompt counts towards your rate limit.
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
 **Image Storage**
 
 All generated and transformed images are automatically saved in your personal gallery!
@@ -202,9 +238,238 @@ Use /gallery to see your collection info.
 - Be creative with transformations
 
 Start creating now!
-    """
+"""
+
+STATS_TEMPLATE = """
+**Your Statistics**
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+**Images Generated:** {images_generated}
+**Images Transformed:** {images_transformed}
+**Images Uploaded:** {images_uploaded}
+**Total Creations:** {total_creations}
+**User ID:** {user_id}
+**Last Prompt:** {last_prompt}
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-    await update.message.reply_text(help_text, parse_mode="Markdown")
+Keep creating amazing images!
+"""
+
+GALLERY_TEMPLATE = """
+**Your Gallery**
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+**Generated Images:** {generated_count}
+**Uploaded Images:** {uploaded_count}
+**Total Images:** {total_count}
+**Storage Used:** {total_size_mb:.2f} MB
+
+**Storage Locations:**
+- Generated: `generated_images/{user_id}/`
+- Uploaded: `uploaded_images/{user_id}/`
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+All your images are safely stored and organized!
+"""
+
+IMAGE_CLEARED_TEXT = (
+    "**Image Cleared**\n\n"
+    "Your uploaded image has been cleared. Upload a new one or send a text prompt."
+)
+
+NO_IMAGE_TEXT = "**No Image**\n\nYou don't have any uploaded image to clear."
+
+STILL_WORKING_TEXT = (
+    "**Still Working**\n\nPlease wait until your current image is finished."
+)
+
+# Photo captions, user supplied values must be passed through escape_markdown
+GENERATED_CAPTION = (
+    "**Image Generated Successfully**\n\n"
+    "Your prompt: {prompt}\n\n"
+    "Saved as: `{filename}`"
+)
+CACHED_CAPTION = (
+    "**Image Generated Successfully**\n\n"
+    "Your prompt: {prompt}\n\n"
+    "Served from cache"
+)
+TRANSFORMED_CAPTION = (
+    "**Image Transformed**\n\nYour request: {prompt}\n\nSaved as: `{filename}`"
+)
+BATCH_CAPTION = "**Batch Image**\n\nYour prompt: {prompt}\n\nSaved as: `{filename}`"
+
+
+def shorten_prompt(prompt):
+    """Truncate a prompt for storage in user stats"""
+    if len(prompt) <= LAST_PROMPT_LENGTH:
+        return prompt
+    return prompt[:LAST_PROMPT_LENGTH] + "..."
+
+
+def ensure_dir(path):
+    """Create a directory once per process, skipping the syscall afterwards"""
+    if path not in ensured_dirs:
+        os.makedirs(path, exist_ok=True)
+        ensured_dirs.add(path)
+
+
+def build_image_filename(image_type="generated"):
+    """Build a timestamped filename for a generated image"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    return f"{image_type}_{timestamp}.png"
+
+
+async def request_generation(prompt):
+    """Generate a single DALL-E 3 image, the SDK retries transient failures"""
+    async with generation_semaphore:
+        return await client.images.generate(
+            model="dall-e-3",
+            prompt=prompt,
+            size="1024x1024",
+            quality="standard",
+            n=1,
+        )
+
+
+async def download_image(image_url):
+    """Stream generated image bytes from URL"""
+    image_data = bytearray()
+
+    async with http_client.stream("GET", image_url) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+            image_data += chunk
+            if len(image_data) > MAX_DOWNLOAD_SIZE:
+                raise ValueError("Generated image is too large to send")
+
+    return bytes(image_data)
+
+
+def save_generated_image(image_data, user_id, filename, image_type="generated"):
+    """Save downloaded image bytes to the user's gallery"""
+    try:
+        # Create user directory
+        user_dir = f"generated_images/{user_id}"
+        ensure_dir(user_dir)
+
+        filepath = os.path.join(user_dir, filename)
+
+        # Save image
+        with open(filepath, "wb") as f:
+            f.write(image_data)
+
+        # Get file size
+        file_size = os.path.getsize(filepath)
+        file_size_kb = file_size / 1024
+
+        logger.info(
+            f"Saved {image_type} image for user {user_id}: {filename} ({file_size_kb:.2f} KB)"
+        )
+
+        return filepath, file_size_kb
+
+    except Exception as e:
+        logger.error(f"Error saving generated image for user {user_id}: {str(e)}")
+        return None, 0
+
+
+async def send_generated_image(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    image_url: str,
+    caption: str,
+    safe_prompt: str,
+    image_type: str = "generated",
+    status_message=None,
+):
+    """Send a generated image and save a copy to the gallery, returns the message"""
+    user_id = update.effective_user.id
+
+    try:
+        image_data = await download_image(image_url)
+    except (httpx.HTTPError, ValueError) as e:
+        # DALL-E has already charged for the image, let Telegram fetch it from
+        # the URL instead and go without the gallery copy
+        logger.warning(
+            f"Could not download {image_type} image for user {user_id}: {str(e)}"
+        )
+        image_data = None
+
+    # The status message is deleted while the photo uploads, a failed delete
+    # only leaves it behind
+    cleanup = [status_message.delete()] if status_message else []
+
+    if image_data is None:
+        sent_message, *_ = await asyncio.gather(
+            update.message.reply_photo(
+                photo=image_url,
+                caption=caption.format(prompt=safe_prompt, filename="N/A"),
+                parse_mode="Markdown",
+            ),
+            *cleanup,
+            return_exceptions=True,
+        )
+        if isinstance(sent_message, Exception):
+            raise sent_message
+        return sent_message
+
+    # Send, save and clean up concurrently
+    filename = build_image_filename(image_type)
+    sent_message, save_result, *_ = await asyncio.gather(
+        update.message.reply_photo(
+            photo=image_data,
+            filename=filename,
+            caption=caption.format(prompt=safe_prompt, filename=filename),
+            parse_mode="Markdown",
+        ),
+        asyncio.to_thread(
+            save_generated_image, image_data, user_id, filename, image_type
+        ),
+        *cleanup,
+        return_exceptions=True,
+    )
+
+    # The file is on disk whether or not the send worked, count it first
+    if not isinstance(save_result, Exception) and save_result[0]:
+        record_gallery_file(context.user_data, "generated", len(image_data))
+
+    if isinstance(sent_message, Exception):
+        raise sent_message
+
+    return sent_message
+
+
+async def report_error(update: Update, status_message, text: str):
+    """Show an error in the status message, or in a new reply once it is gone"""
+    try:
+        if status_message:
+            await status_message.edit_text(text, parse_mode="Markdown")
+        else:
+            await update.message.reply_text(text, parse_mode="Markdown")
+    except TelegramError as e:
+        logger.debug(f"Could not report error: {str(e)}")
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    logger.info(f"User {user.id} ({user.first_name}) started the bot")
+
+    await update.message.reply_text(
+        WELCOME_TEMPLATE.format(first_name=escape_markdown(user.first_name)),
+        parse_mode="Markdown",
+    )
+
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    logger.info(f"User {user.id} requested help")
+
+    await update.message.reply_text(HELP_TEXT, parse_mode="Markdown")
 
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -218,80 +483,81 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     logger.info(f"User {user.id} requested stats")
 
-    stats_text = f"""
-**Your Statistics**
-
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+    stats_text = STATS_TEMPLATE.format(
+        images_generated=images_generated,
+        images_transformed=images_transformed,
+        images_uploaded=images_uploaded,
+        total_creations=images_generated + images_transformed,
+        user_id=user.id,
+        last_prompt=escape_markdown(last_prompt),
+    )
 
-**Images Generated:** {images_generated}
-**Images Transformed:** {images_transformed}
-**Images Uploaded:** {images_uploaded}
-**Total Creations:** {images_generated + images_transformed}
-**User ID:** {user.id}
-**Last Prompt:** {last_prompt[:50]}...
+    await update.message.reply_text(stats_text, parse_mode="Markdown")
 
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-Keep creating amazing images!
-    """
+def count_images(directory):
+    """Count image files and their total size with a single directory scan"""
+    count = 0
+    total_size = 0
 
-    await update.message.reply_text(stats_text, parse_mode="Markdown")
+    if not os.path.exists(directory):
+        return count, total_size
 
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith((".jpg", ".png", ".jpeg")):
+                count += 1
+                total_size += entry.stat().st_size
 
-async def gallery_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    user_data = context.user_data
+    return count, total_size
 
-    # Count files in user's directories
-    generated_dir = f"generated_images/{user.id}"
-    uploaded_dir = f"uploaded_images/{user.id}"
 
-    generated_count = 0
-    uploaded_count = 0
-    total_size = 0
+def scan_gallery(user_id):
+    """Count the files and bytes in a user's gallery directories"""
+    generated_count, generated_size = count_images(f"generated_images/{user_id}")
+    uploaded_count, uploaded_size = count_images(f"uploaded_images/{user_id}")
 
-    if os.path.exists(generated_dir):
-        generated_files = [
-            f
-            for f in os.listdir(generated_dir)
-            if f.endswith((".jpg", ".png", ".jpeg"))
-        ]
-        generated_count = len(generated_files)
-        total_size += sum(
-            os.path.getsize(os.path.join(generated_dir, f)) for f in generated_files
-        )
+    return {
+        "generated_count": generated_count,
+        "uploaded_count": uploaded_count,
+        "total_size": generated_size + uploaded_size,
+    }
 
-    if os.path.exists(uploaded_dir):
-        uploaded_files = [
-            f for f in os.listdir(uploaded_dir) if f.endswith((".jpg", ".png", ".jpeg"))
-        ]
-        uploaded_count = len(uploaded_files)
-        total_size += sum(
-            os.path.getsize(os.path.join(uploaded_dir, f)) for f in uploaded_files
-        )
 
-    total_size_mb = total_size / (1024 * 1024)
+def record_gallery_file(user_data, kind, file_size):
+    """Update cached gallery counters after a file was saved"""
+    gallery = user_data.get("gallery")
+    if gallery is None:
+        # Not scanned yet, the first /gallery call will count this file
+        return
 
-    logger.info(f"User {user.id} requested gallery info")
+    gallery[f"{kind}_count"] += 1
+    gallery["total_size"] += file_size
 
-    gallery_text = f"""
-**Your Gallery**
 
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+async def gallery_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    user_data = context.user_data
 
-**Generated Images:** {generated_count}
-**Uploaded Images:** {uploaded_count}
-**Total Images:** {generated_count + uploaded_count}
-**Storage Used:** {total_size_mb:.2f} MB
+    # Counters are kept up to date on every save, scan the disk only once
+    gallery = user_data.get("gallery")
+    if gallery is None:
+        gallery = await asyncio.to_thread(scan_gallery, user.id)
+        user_data["gallery"] = gallery
 
-**Storage Locations:**
-- Generated: `generated_images/{user.id}/`
-- Uploaded: `uploaded_images/{user.id}/`
+    generated_count = gallery["generated_count"]
+    uploaded_count = gallery["uploaded_count"]
+    total_size_mb = gallery["total_size"] / (1024 * 1024)
 
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+    logger.info(f"User {user.id} requested gallery info")
 
-All your images are safely stored and organized!
-    """
+    gallery_text = GALLERY_TEMPLATE.format(
+        generated_count=generated_count,
+        uploaded_count=uploaded_count,
+        total_count=generated_count + uploaded_count,
+        total_size_mb=total_size_mb,
+        user_id=user.id,
+    )
 
     await update.message.reply_text(gallery_text, parse_mode="Markdown")
 
@@ -302,63 +568,140 @@ async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if "uploaded_image_path" in user_data:
         del user_data["uploaded_image_path"]
-        await update.message.reply_text(
-            "**Image Cleared**\n\nYour uploaded image has been cleared. Upload a new one or send a text prompt.",
-            parse_mode="Markdown",
-        )
+        await update.message.reply_text(IMAGE_CLEARED_TEXT, parse_mode="Markdown")
     else:
-        await update.message.reply_text(
-            "**No Image**\n\nYou don't have any uploaded image to clear.",
-            parse_mode="Markdown",
-        )
+        await update.message.reply_text(NO_IMAGE_TEXT, parse_mode="Markdown")
 
     logger.info(f"User {user.id} cleared uploaded image")
 
 
-def check_rate_limit(user_id: int) -> tuple[bool, int]:
-    """Check if user has exceeded rate limit"""
-    current_time = datetime.now().timestamp()
+def check_rate_limit(user_id: int, cost: int = 1) -> tuple[bool, int]:
+    """Check if user has exceeded rate limit (token bucket)"""
+    # No awaits in here, so the check-and-take is atomic on the event loop
+    # without a lock. Callers that are out of tokens get the wait time back
+    # instead of sleeping, which keeps other users from queueing behind them.
+    current_time = time.monotonic()
+
+    # Refill lazily based on the time since the last check
+    tokens, last_refill = rate_limit_buckets.get(
+        user_id, (RATE_LIMIT_CAPACITY, current_time)
+    )
+    tokens = min(
+        RATE_LIMIT_CAPACITY,
+        tokens + (current_time - last_refill) * RATE_LIMIT_REFILL_RATE,
+    )
 
-    if user_id in user_last_request:
-        time_elapsed = current_time - user_last_request[user_id]
-        if time_elapsed < REQUEST_COOLDOWN:
-            wait_time = int(REQUEST_COOLDOWN - time_elapsed)
-            return False, wait_time
+    allowed = tokens >= cost
+    if allowed:
+        tokens -= cost
+
+    rate_limit_buckets[user_id] = (tokens, current_time)
+    rate_limit_buckets.move_to_end(user_id)
+
+    # Evict the least recently seen user if a burst of new users hits the cap
+    if len(rate_limit_buckets) > RATE_LIMIT_MAX_USERS:
+        rate_limit_buckets.popitem(last=False)
+
+    if not allowed:
+        wait_time = math.ceil((cost - tokens) / RATE_LIMIT_REFILL_RATE)
+        return False, wait_time
 
-    user_last_request[user_id] = current_time
     return True, 0
 
 
-def encode_image_to_base64(image_path):
-    """Encode image to base64 for OpenAI API"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+async def sweep_rate_limit_buckets():
+    """Periodically drop buckets that have refilled to capacity"""
+    # A full bucket behaves exactly like a missing one, so evicting it is lossless
+    full_after = RATE_LIMIT_CAPACITY / RATE_LIMIT_REFILL_RATE
+
+    while True:
+        await asyncio.sleep(RATE_LIMIT_SWEEP_INTERVAL)
+
+        # Oldest buckets come first, stop at the first one still refilling
+        current_time = time.monotonic()
+        evicted = 0
+        while rate_limit_buckets:
+            tokens, last_refill = next(iter(rate_limit_buckets.values()))
+            if current_time - last_refill < full_after:
+                break
+            rate_limit_buckets.popitem(last=False)
+            evicted += 1
+
+        if evicted:
+            logger.debug(f"Evicted {evicted} idle rate limit buckets")
+
+
+def prompt_cache_key(prompt: str) -> bytes:
+    """Hash a normalized prompt for the prompt cache"""
+    return hashlib.sha256(prompt.strip().lower().encode("utf-8")).digest()
+
+
+def get_cached_image(prompt: str):
+    """Return a cached image for this prompt, or None"""
+    key = prompt_cache_key(prompt)
+    file_id = prompt_cache.get(key)
+    if file_id is None:
+        return None
+
+    prompt_cache.move_to_end(key)
+    return file_id
+
+
+def cache_image(prompt: str, file_id: str):
+    """Remember the Telegram photo sent for this prompt"""
+    key = prompt_cache_key(prompt)
+    prompt_cache[key] = file_id
+    prompt_cache.move_to_end(key)
+
+    # Evict the least recently used prompt
+    if len(prompt_cache) > PROMPT_CACHE_SIZE:
+        prompt_cache.popitem(last=False)
+
+
+def forget_cached_image(prompt: str):
+    """Drop a cached image that can no longer be sent"""
+    prompt_cache.pop(prompt_cache_key(prompt), None)
 
 
 def prepare_image_for_api(image_path):
-    """Resize and prepare image for OpenAI API (max 4MB, PNG)"""
-    img = Image.open(image_path)
-
-    # Convert to RGB if necessary
-    if img.mode in ("RGBA", "LA", "P"):
-        background = Image.new("RGB", img.size, (255, 255, 255))
-        if img.mode == "P":
-            img = img.convert("RGBA")
-        background.paste(
-            img, mask=img.split()[-1] if img.mode in ("RGBA", "LA") else None
-        )
-        img = background
+    """Resize and prepare image for OpenAI API (max 4MB, PNG), returns a buffer"""
+    with Image.open(image_path) as original:
+        img = original
+        background = None
+
+        try:
+            # Convert to RGB if necessary
+            if img.mode in ("RGBA", "LA", "P"):
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                if img.mode == "P":
+                    img = img.convert("RGBA")
+                background.paste(
+                    img, mask=img.split()[-1] if img.mode in ("RGBA", "LA") else None
+                )
+                if img is not original:
+                    img.close()
+                img = background
+
+            # Resize if too large (max 1024x1024 for DALL-E)
+            max_size = 1024
+            if img.width > max_size or img.height > max_size:
+                img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
 
-    # Resize if too large (max 1024x1024 for DALL-E)
-    max_size = 1024
-    if img.width > max_size or img.height > max_size:
-        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+            # Encode as PNG in memory, this copy is never written to disk so
+            # the fastest zlib level is worth the slightly larger output
+            buffer = BytesIO()
+            img.save(buffer, "PNG", compress_level=1)
 
-    # Save as PNG
-    output_path = image_path.rsplit(".", 1)[0] + "_prepared.png"
-    img.save(output_path, "PNG", optimize=True)
+        finally:
+            # Free pixel storage of intermediate images right away, including
+            # a background left behind when the conversion fails halfway
+            if img is not original:
+                img.close()
+            if background is not None and background is not img:
+                background.close()
 
-    return output_path
+    buffer.seek(0)
+    return buffer
 
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -374,16 +717,17 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Create user directory if it doesn't exist
         user_dir = f"uploaded_images/{user.id}"
-        os.makedirs(user_dir, exist_ok=True)
+        ensure_dir(user_dir)
 
         # Generate filename with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
         filename = f"upload_{timestamp}.jpg"
         filepath = os.path.join(user_dir, filename)
 
         # Download the photo
         file = await context.bot.get_file(photo.file_id)
         await file.download_to_drive(filepath)
+        record_gallery_file(user_data, "uploaded", os.path.getsize(filepath))
 
         # Store the image path in user data
         user_data["uploaded_image_path"] = filepath
@@ -445,6 +789,11 @@ async def transform_image(
         )
         return
 
+    # One request in flight per user so nobody can queue work ahead of others
+    if user.id in users_in_flight:
+        await update.message.reply_text(STILL_WORKING_TEXT, parse_mode="Markdown")
+        return
+
     # Rate limiting
     can_proceed, wait_time = check_rate_limit(user.id)
     if not can_proceed:
@@ -458,78 +807,58 @@ async def transform_image(
 
     logger.info(f"User {user.id} requested image transformation: '{prompt}'")
 
-    status_message = await update.message.reply_text(
-        f"**Transforming Image**\n\n"
-        f"Request: _{prompt}_\n\n"
-        f"Processing... This may take 10-30 seconds.",
-        parse_mode="Markdown",
-    )
+    # Escape once, user text must not be parsed as Markdown
+    safe_prompt = escape_markdown(prompt)
 
-    try:
-        image_path = user_data["uploaded_image_path"]
+    # Captured now, /clear or a new upload may change it while we work
+    image_path = user_data["uploaded_image_path"]
 
-        # Prepare image for API
-        prepared_image_path = prepare_image_for_api(image_path)
+    users_in_flight.add(user.id)
+    status_message = None
+
+    try:
+        status_message = await update.message.reply_text(
+            f"**Transforming Image**\n\n"
+            f"Request: {safe_prompt}\n\n"
+            f"Processing... This may take 10-30 seconds.",
+            parse_mode="Markdown",
+        )
 
-        # Read and encode image
-        with open(prepared_image_path, "rb") as image_file:
-            image_data = image_file.read()
+        # Prepare image for API, PIL work runs off the event loop. images.generate
+        # only takes a prompt, so this just checks the upload decodes and the
+        # buffer is released right away instead of living through the DALL-E call
+        prepared_image = await asyncio.to_thread(prepare_image_for_api, image_path)
+        prepared_image.close()
 
         # Create variation using DALL-E
         full_prompt = f"An image that {prompt}, maintaining the essence and subject of the original"
 
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                response = client.images.generate(
-                    model="dall-e-3",
-                    prompt=full_prompt,
-                    size="1024x1024",
-                    quality="standard",
-                    n=1,
-                )
-                break
-            except APIConnectionError as e:
-                if attempt < max_retries - 1:
-                    logger.warning(
-                        f"Connection error, retrying... (attempt {attempt + 1}/{max_retries})"
-                    )
-                    await asyncio.sleep(2)
-                    continue
-                else:
-                    raise
+        response = await request_generation(full_prompt)
 
         image_url = response.data[0].url
         revised_prompt = response.data[0].revised_prompt
 
-        # Save the generated image
-        saved_path, file_size = save_generated_image(image_url, user.id, "transformed")
-
-        # Send transformed image
-        await update.message.reply_photo(
-            photo=image_url,
-            caption=f"**Image Transformed**\n\n"
-            f"Your request: _{prompt}_\n\n"
-            f"Saved as: `{os.path.basename(saved_path) if saved_path else 'N/A'}`",
-            parse_mode="Markdown",
+        # The status message goes away while the photo uploads, so errors from
+        # here on are reported in a fresh reply
+        finished_status, status_message = status_message, None
+        sent_message = await send_generated_image(
+            update,
+            context,
+            image_url,
+            TRANSFORMED_CAPTION,
+            safe_prompt,
+            "transformed",
+            status_message=finished_status,
         )
 
-        # Delete status message
-        try:
-            await status_message.delete()
-        except:
-            pass
-
-        # Clean up prepared image
-        if os.path.exists(prepared_image_path):
-            os.remove(prepared_image_path)
-
-        # Clear the uploaded image after successful transformation
-        del user_data["uploaded_image_path"]
+        # Clear the uploaded image after successful transformation, unless the
+        # user cleared it or uploaded a new one while this was running
+        if user_data.get("uploaded_image_path") == image_path:
+            user_data.pop("uploaded_image_path")
 
         # Update stats
         user_data["images_transformed"] = user_data.get("images_transformed", 0) + 1
-        user_data["last_prompt"] = prompt
+        user_data["last_prompt"] = shorten_prompt(prompt)
 
         logger.info(
             f"Successfully transformed image for user {user.id}. Total: {user_data['images_transformed']}"
@@ -556,7 +885,7 @@ async def transform_image(
     except APIError as e:
         logger.error(f"OpenAI API error for user {user.id}: {str(e)}")
 
-        if "content_policy_violation" in str(e).lower():
+        if e.code == "content_policy_violation":
             await status_message.edit_text(
                 f"**Content Policy Violation**\n\n"
                 f"Your transformation request or image violates OpenAI's content policy.\n\n"
@@ -581,16 +910,17 @@ async def transform_image(
             exc_info=True,
         )
 
-        try:
-            await status_message.edit_text(
-                f"**Transformation Error**\n\n"
-                f"An unexpected error occurred.\n\n"
-                f"Error: {error_msg[:100]}\n\n"
-                f"Please try again or upload a different image.",
-                parse_mode="Markdown",
-            )
-        except:
-            pass
+        await report_error(
+            update,
+            status_message,
+            f"**Transformation Error**\n\n"
+            f"An unexpected error occurred.\n\n"
+            f"Error: {escape_markdown(error_msg[:100])}\n\n"
+            f"Please try again or upload a different image.",
+        )
+
+    finally:
+        users_in_flight.discard(user.id)
 
 
 async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -603,6 +933,14 @@ async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await transform_image(update, context, prompt)
         return
 
+    # Escape once, user text must not be parsed as Markdown
+    safe_prompt = escape_markdown(prompt)
+
+    # One request in flight per user so nobody can queue work ahead of others
+    if user.id in users_in_flight:
+        await update.message.reply_text(STILL_WORKING_TEXT, parse_mode="Markdown")
+        return
+
     # Rate limiting
     can_proceed, wait_time = check_rate_limit(user.id)
     if not can_proceed:
@@ -614,58 +952,65 @@ async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.warning(f"Rate limit hit for user {user.id}")
         return
 
-    logger.info(f"User {user.id} ({user.first_name}) requested image: '{prompt}'")
-
-    status_message = await update.message.reply_text(
-        f"**Creating Your Image**\n\n"
-        f"Prompt: _{prompt}_\n\n"
-        f"Processing... This typically takes 10-30 seconds.",
-        parse_mode="Markdown",
-    )
+    # In flight from here on, including a cache hit, so a second message can't
+    # slip past the check while the cached photo is being sent
+    users_in_flight.add(user.id)
+    status_message = None
 
     try:
-        max_retries = 3
-        for attempt in range(max_retries):
+        # Serve repeated prompts from cache without calling DALL-E. This runs after
+        # the rate limit, every hit is still a send against the bot's shared quota
+        cached_image = get_cached_image(prompt)
+        if cached_image:
             try:
-                response = client.images.generate(
-                    model="dall-e-3",
-                    prompt=prompt,
-                    size="1024x1024",
-                    quality="standard",
-                    n=1,
+                await update.message.reply_photo(
+                    photo=cached_image,
+                    caption=CACHED_CAPTION.format(prompt=safe_prompt),
+                    parse_mode="Markdown",
                 )
-                break
-            except APIConnectionError as e:
-                if attempt < max_retries - 1:
-                    logger.warning(
-                        f"Connection error, retrying... (attempt {attempt + 1}/{max_retries})"
-                    )
-                    await asyncio.sleep(2)
-                    continue
-                else:
-                    raise
 
-        image_url = response.data[0].url
-        revised_prompt = response.data[0].revised_prompt
+                user_data["images_generated"] = user_data.get("images_generated", 0) + 1
+                user_data["last_prompt"] = shorten_prompt(prompt)
+
+                logger.info(f"Served cached image for user {user.id}")
+                return
 
-        # Save the generated image
-        saved_path, file_size = save_generated_image(image_url, user.id, "generated")
+            except TelegramError as e:
+                # Cached image is no longer usable, generate a fresh one
+                logger.warning(f"Cached image failed for user {user.id}: {str(e)}")
+                forget_cached_image(prompt)
 
-        await update.message.reply_photo(
-            photo=image_url,
-            caption=f"**Image Generated Successfully**\n\n"
-            f"Your prompt: _{prompt}_\n\n"
-            f"Saved as: `{os.path.basename(saved_path) if saved_path else 'N/A'}`",
+        logger.info(f"User {user.id} ({user.first_name}) requested image: '{prompt}'")
+
+        status_message = await update.message.reply_text(
+            f"**Creating Your Image**\n\n"
+            f"Prompt: {safe_prompt}\n\n"
+            f"Processing... This typically takes 10-30 seconds.",
             parse_mode="Markdown",
         )
 
-        try:
-            await status_message.delete()
-        except:
-            pass
+        response = await request_generation(prompt)
+
+        image_url = response.data[0].url
+        revised_prompt = response.data[0].revised_prompt
+
+        # The status message goes away while the photo uploads, so errors from
+        # here on are reported in a fresh reply
+        finished_status, status_message = status_message, None
+        sent_message = await send_generated_image(
+            update,
+            context,
+            image_url,
+            GENERATED_CAPTION,
+            safe_prompt,
+            status_message=finished_status,
+        )
+
+        # Telegram file_ids can be resent without uploading the image again
+        cache_image(prompt, sent_message.photo[-1].file_id)
 
         user_data["images_generated"] = user_data.get("images_generated", 0) + 1
-        user_data["last_prompt"] = prompt
+        user_data["last_prompt"] = shorten_prompt(prompt)
 
         logger.info(
             f"Successfully generated image for user {user.id}. Total: {user_data['images_generated']}"
@@ -692,7 +1037,7 @@ async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except APIError as e:
         logger.error(f"OpenAI API error for user {user.id}: {str(e)}")
 
-        if "content_policy_violation" in str(e).lower():
+        if e.code == "content_policy_violation":
             await status_message.edit_text(
                 f"**Content Policy Violation**\n\n"
                 f"Your prompt violates OpenAI's content policy.\n\n"
@@ -714,16 +1059,127 @@ async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
         error_msg = str(e)
         logger.error(f"Unexpected error for user {user.id}: {error_msg}", exc_info=True)
 
-        try:
-            await status_message.edit_text(
-                f"**Unexpected Error**\n\n"
-                f"An unexpected error occurred.\n\n"
-                f"Error: {error_msg[:100]}\n\n"
-                f"Please try again.",
-                parse_mode="Markdown",
+        await report_error(
+            update,
+            status_message,
+            f"**Unexpected Error**\n\n"
+            f"An unexpected error occurred.\n\n"
+            f"Error: {escape_markdown(error_msg[:100])}\n\n"
+            f"Please try again.",
+        )
+
+    finally:
+        users_in_flight.discard(user.id)
+
+
+async def send_batch_image(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str
+):
+    """Generate, send and save one image of a batch"""
+    response = await request_generation(prompt)
+    await send_generated_image(
+        update, context, response.data[0].url, BATCH_CAPTION, escape_markdown(prompt)
+    )
+
+
+async def batch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Generate one image per line of the message, in parallel"""
+    user = update.effective_user
+    user_data = context.user_data
+
+    # Everything after the command, one prompt per line
+    parts = update.message.text.split(maxsplit=1)
+    lines = parts[1].split("\n") if len(parts) > 1 else []
+    prompts = [line.strip() for line in lines if line.strip()][:BATCH_MAX_PROMPTS]
+
+    if not prompts:
+        await update.message.reply_text(
+            f"**Batch Generation**\n\n"
+            f"Send up to {BATCH_MAX_PROMPTS} prompts, one per line:\n\n"
+            f"/batch A lighthouse at dawn\n"
+            f"A lighthouse at noon\n"
+            f"A lighthouse at night",
+            parse_mode="Markdown",
+        )
+        return
+
+    # One request in flight per user so nobody can queue work ahead of others
+    if user.id in users_in_flight:
+        await update.message.reply_text(STILL_WORKING_TEXT, parse_mode="Markdown")
+        return
+
+    # Rate limiting, one token per prompt
+    can_proceed, wait_time = check_rate_limit(user.id, cost=len(prompts))
+    if not can_proceed:
+        await update.message.reply_text(
+            f"**Rate Limit**\n\n"
+            f"Please wait {wait_time} seconds before generating {len(prompts)} more images.",
+            parse_mode="Markdown",
+        )
+        logger.warning(f"Rate limit hit for user {user.id}")
+        return
+
+    logger.info(f"User {user.id} ({user.first_name}) requested batch of {len(prompts)}")
+
+    users_in_flight.add(user.id)
+
+    try:
+        status_message = await update.message.reply_text(
+            f"**Creating {len(prompts)} Images**\n\n"
+            f"Processing... This typically takes 10-30 seconds.",
+            parse_mode="Markdown",
+        )
+
+        results = await asyncio.gather(
+            *(send_batch_image(update, context, prompt) for prompt in prompts),
+            return_exceptions=True,
+        )
+
+        failures = [r for r in results if isinstance(r, Exception)]
+        for error in failures:
+            logger.error(f"Batch image failed for user {user.id}: {str(error)}")
+
+        succeeded = len(prompts) - len(failures)
+        if succeeded:
+            user_data["images_generated"] = (
+                user_data.get("images_generated", 0) + succeeded
             )
-        except:
-            pass
+            user_data["last_prompt"] = shorten_prompt(prompts[-1])
+
+        logger.info(
+            f"Batch finished for user {user.id}: {succeeded}/{len(prompts)} images generated"
+        )
+
+        try:
+            if failures:
+                await status_message.edit_text(
+                    f"**Batch Finished**\n\n"
+                    f"{succeeded} of {len(prompts)} images were generated.\n\n"
+                    f"Please try the failed prompts again individually.",
+                    parse_mode="Markdown",
+                )
+            else:
+                await status_message.delete()
+        except TelegramError as e:
+            logger.debug(f"Could not update batch status message: {str(e)}")
+
+    finally:
+        users_in_flight.discard(user.id)
+
+
+async def post_init(application: Application):
+    """Start background maintenance tasks once the bot is initialized"""
+    global rate_limit_sweeper
+    rate_limit_sweeper = asyncio.create_task(sweep_rate_limit_buckets())
+
+
+async def post_shutdown(application: Application):
+    """Stop background tasks and release shared clients once the bot has stopped"""
+    if rate_limit_sweeper:
+        rate_limit_sweeper.cancel()
+
+    await client.close()
+    await http_client.aclose()
 
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -740,8 +1196,8 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "Please try again.",
                 parse_mode="Markdown",
             )
-        except:
-            pass
+        except TelegramError as e:
+            logger.debug(f"Could not send error message: {str(e)}")
 
 
 def main():
@@ -753,15 +1209,25 @@ def main():
         return
 
     try:
+        # Keep user statistics across restarts, flushed to disk every 30 seconds
+        persistence = PicklePersistence(filepath="bot_state.pkl", update_interval=30)
+
         app = (
             Application.builder()
             .token(TELEGRAM_TOKEN)
+            .persistence(persistence)
+            # Handle updates concurrently, one user's DALL-E call must not
+            # hold up everyone else's messages
+            .concurrent_updates(True)
+            .connection_pool_size(64)
             .connect_timeout(30.0)
             .read_timeout(30.0)
             .write_timeout(30.0)
-            .pool_timeout(30.0)
+            .pool_timeout(5.0)
             .get_updates_connect_timeout(30.0)
             .get_updates_read_timeout(30.0)
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
             .build()
         )
 
@@ -771,6 +1237,7 @@ def main():
         app.add_handler(CommandHandler("stats", stats_command))
         app.add_handler(CommandHandler("gallery", gallery_command))
         app.add_handler(CommandHandler("clear", clear_command))
+        app.add_handler(CommandHandler("batch", batch_command))
 
         # Photo handler (must come before text handler)
         app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
@@ -788,9 +1255,23 @@ def main():
         print(f"Started at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         print("Press Ctrl+C to stop\n")
 
-        app.run_polling(
-            allowed_updates=Update.ALL_TYPES, drop_pending_updates=True, timeout=30
-        )
+        # Every handler works on plain messages, so skip all other update types
+        if WEBHOOK_URL:
+            # Telegram pushes updates to us, no long-poll round trips
+            logger.info(f"Receiving updates via webhook on port {WEBHOOK_PORT}")
+            app.run_webhook(
+                listen="0.0.0.0",
+                port=WEBHOOK_PORT,
+                url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=[Update.MESSAGE],
+                drop_pending_updates=True,
+            )
+        else:
+            app.run_polling(
+                allowed_updates=[Update.MESSAGE], drop_pending_updates=True, timeout=30
+            )
 
     except Exception as e:
         logger.error(f"Failed to start bot: {str(e)}", exc_info=True)